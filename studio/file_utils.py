@@ -1,8 +1,72 @@
+import json
 import os
 from pathlib import Path
 import shutil
 from typing import Optional
 
+try:
+    import orjson  # Optional, encodes large file trees considerably faster.
+except ImportError:
+    orjson = None
+
+# In-memory file tree kept in sync by the mutation helpers below, nodes are indexed by path.
+_tree_cache = {'root': None, 'tree': None, 'nodes': {}, 'json': None}
+
+def _reset_file_tree() -> None:
+    _tree_cache.update(root=None, tree=None, nodes={}, json=None)
+
+def _index_node(node: dict) -> None:
+    _tree_cache['nodes'][node['path']] = node
+    for child in node.get('children', []):
+        _index_node(child)
+
+def _unindex_node(node: dict) -> None:
+    _tree_cache['nodes'].pop(node['path'], None)
+    for child in node.get('children', []):
+        _unindex_node(child)
+
+def _add_tree_node(path: str, is_folder: bool) -> None:
+    parent = _tree_cache['nodes'].get(os.path.dirname(path))
+    if parent is None:
+        _reset_file_tree()
+        return
+    node = {'label': os.path.basename(path), 'isFolder': is_folder, 'path': path}
+    children = parent['children']
+    if is_folder:
+        node['children'] = []
+        # Keep folders ahead of files, the same order get_file_tree produces.
+        children.insert(next((i for i, c in enumerate(children) if not c['isFolder']), len(children)), node)
+    else:
+        children.append(node)
+    _index_node(node)
+    _tree_cache['json'] = None
+
+def _remove_tree_node(path: str) -> None:
+    node = _tree_cache['nodes'].get(path)
+    parent = _tree_cache['nodes'].get(os.path.dirname(path))
+    if node is None or parent is None:
+        _reset_file_tree()
+        return
+    parent['children'] = [c for c in parent['children'] if c is not node]
+    _unindex_node(node)
+    _tree_cache['json'] = None
+
+def _move_tree_node(node: dict, path: str) -> None:
+    node['label'] = os.path.basename(path)
+    node['path'] = path
+    for child in node.get('children', []):
+        _move_tree_node(child, os.path.join(path, child['label']))
+
+def _rename_tree_node(path: str, new_path: str) -> None:
+    node = _tree_cache['nodes'].get(path)
+    if node is None or node is _tree_cache['tree']:
+        _reset_file_tree()
+        return
+    _unindex_node(node)
+    _move_tree_node(node, new_path)
+    _index_node(node)
+    _tree_cache['json'] = None
+
 def read_file(p: str) -> str:
     try:
         with open(p, encoding='utf-8') as f:
@@ -10,31 +74,38 @@ def read_file(p: str) -> str:
     except:
         return ''
 
+def write_file(p: str, content: str) -> None:
+    with open(p, 'w', encoding='utf-8') as f:
+        f.write(content)
+
 def create_file(path:str) -> None:
     path = Path(path)
     if not path.exists():
         path.touch()
+        _add_tree_node(str(path), False)
 
 def create_folder(path:str) -> None:
     dirpath = Path(path)
     if not dirpath.exists():
         os.mkdir(path)
+        _add_tree_node(str(dirpath), True)
 
 def rename(path:str, new_name:str):
-    os.rename(path, os.path.join(os.path.dirname(path), new_name))
+    new_path = os.path.join(os.path.dirname(path), new_name)
+    os.rename(path, new_path)
+    _rename_tree_node(path, new_path)
 
 def remove_file(path:str) -> None:
     path = Path(path)
     if path.exists():
         os.remove(path)
+        _remove_tree_node(str(path))
 
 def remove_folder(path:str) -> None:
     dirpath = Path(path)
     if dirpath.exists():
         shutil.rmtree(dirpath)
-
-def pythonify_js_code(code:str) -> str:
-    return code.replace("`", "\\`").replace('$', '\\$')
+        _remove_tree_node(str(dirpath))
 
 def get_file_tree(path):
     ret = {}
@@ -50,6 +121,32 @@ def get_file_tree(path):
         return ret # Stop recursive os.walk.
     return ret
 
+def set_file_tree(path: str, tree: dict) -> None:
+    _reset_file_tree()
+    _tree_cache['root'] = path
+    _tree_cache['tree'] = tree
+    if tree:
+        _index_node(tree)
+
+def get_file_tree_json(path: str) -> str:
+    if _tree_cache['root'] != path:
+        set_file_tree(path, get_file_tree(path))
+    if _tree_cache['json'] is None:
+        tree = _tree_cache['tree']
+        _tree_cache['json'] = orjson.dumps(tree).decode() if orjson else json.dumps(tree)
+    return _tree_cache['json']
+
+def warm_page_cache(root: str, chunk_size: int = 1024 * 1024) -> None:
+    for dirpath, _dirs, files in os.walk(root):
+        for f in files:
+            try:
+                with open(os.path.join(dirpath, f), 'rb') as fp:
+                    # Data is dropped right away, only the OS page cache is meant to keep it.
+                    while fp.read(chunk_size):
+                        pass
+            except OSError:
+                pass
+
 def find_main_file(root: str) -> Optional[str]:
     for dirpath, _dirs, files in os.walk(root):
         for f in files:
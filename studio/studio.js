@@ -51,7 +51,7 @@ require(['vs/editor/editor.main', 'pyodide'], async () => {
     }
   })
   const editor = monaco.editor.create(document.getElementById('monaco-editor'), {
-    value: `$file_content`,
+    value: $file_content,
     language: 'python',
     minimap: { enabled: false },
     overviewRulerLanes: 0,
@@ -65,7 +65,7 @@ require(['vs/editor/editor.main', 'pyodide'], async () => {
   window.pyodide = await window.loadPyodide()
   await window.pyodide.loadPackage('parso')
   await window.pyodide.loadPackage('jedi')
-  await window.pyodide.runPythonAsync(`$py_content`)
+  if ('$autocomplete_url') await window.pyodide.runPythonAsync(await fetch('$autocomplete_url').then(r => r.text()))
   editor.onDidChangeModelContent(e => {
     if (e.isFlush) return
     emit_debounced('editor', 'change', editor.getValue())
@@ -1,15 +1,19 @@
 import asyncio
+import codecs
+import collections
+import hashlib
 import json
 import os
 import os.path
 import re
 import shutil
 import sys
+import tempfile
 import time
 import zipfile
 from pathlib import Path
 from string import Template
-from subprocess import PIPE, STDOUT, Popen
+from subprocess import PIPE, STDOUT
 from urllib.parse import urlparse
 
 from h2o_wave import Q, app, main, ui
@@ -17,6 +21,21 @@ from h2o_wave import Q, app, main, ui
 import file_utils
 import studio_editor as editor
 
+_APP_RE = re.compile(r'\n@app\([^\'"\n]*[\'"]([^\'"\n]*)[\'"]')
+_SITE_RE = re.compile(r'site\[[\'"]([^\'"\n]*)[\'"]\]')
+
+_SHOWN = ui.box('main', width='100%')
+_HIDDEN = ui.box('main', width='0px')
+# Boxes of the preview, code and logs cards plus the console toggle button (name, label, icon) per view.
+# None leaves the card or button untouched.
+_VIEWS = {
+    'code': (_HIDDEN, _SHOWN, None, None),
+    'split': (_SHOWN, _SHOWN, None, None),
+    'preview': (_SHOWN, _HIDDEN, None, None),
+    'console': (_SHOWN, _HIDDEN, _SHOWN, ('show_code', 'Code', 'Code')),
+    'show_code': (None, None, _HIDDEN, ('console', 'Console', 'CommandPrompt')),
+}
+
 
 class Project:
     def __init__(self) -> None:
@@ -28,6 +47,22 @@ class Project:
         self.app_port = '10102'
         self.vsc_extension_path = os.path.join('..', 'tools', 'vscode-extension')
         self.entry_point = os.path.join(self.dir, 'app.py')
+        # On Windows, terminate() only stops the uvicorn reloader and its worker would keep the app port.
+        self.hot_reload = not sys.platform.lower().startswith('win')
+        # Subprocess environments do not change at runtime, build them once instead of per spawn.
+        self.script_env = self.get_script_env()
+        self.app_env = {**self.script_env, 'H2O_WAVE_APP_ADDRESS': f'http://{self.app_host}:{self.app_port}'}
+
+    def get_script_env(self) -> dict:
+        env = os.environ.copy()
+        env['H2O_WAVE_BASE_URL'] = self.server_base_url
+        env['H2O_WAVE_ADDRESS'] = self.internal_server_adress
+        env['PYTHONUNBUFFERED'] = 'False'
+        # The environment passed into Popen must include SYSTEMROOT, otherwise Popen will fail when called
+        # inside python during initialization if %PATH% is configured, but without %SYSTEMROOT%.
+        if sys.platform.lower().startswith('win'):
+            env['SYSTEMROOT'] = os.environ['SYSTEMROOT']
+        return env
 
     def get_server_address(self) -> str:
         cloud_env = os.environ.get('H2O_CLOUD_ENVIRONMENT', None)
@@ -38,26 +73,20 @@ class Project:
 
 project = Project()
 
-def start(entry_point: str, is_app: bool):
-    env = os.environ.copy()
-    env['H2O_WAVE_BASE_URL'] = project.server_base_url
-    env['H2O_WAVE_ADDRESS'] = project.internal_server_adress
-    env['PYTHONUNBUFFERED'] = 'False'
-    # The environment passed into Popen must include SYSTEMROOT, otherwise Popen will fail when called
-    # inside python during initialization if %PATH% is configured, but without %SYSTEMROOT%.
-    if sys.platform.lower().startswith('win'):
-        env['SYSTEMROOT'] = os.environ['SYSTEMROOT']
+async def start(entry_point: str, is_app: bool):
     if is_app:
-        env['H2O_WAVE_APP_ADDRESS'] = f'http://{project.app_host}:{project.app_port}'
         entry_point = project.entry_point.replace(os.sep, '.').replace('.py', '')
-        return Popen([
+        return await asyncio.create_subprocess_exec(
             sys.executable, '-m', 'uvicorn',
             '--host', '0.0.0.0',
             '--port', project.app_port,
+            # Keep the app process alive across edits, uvicorn reloads it on Python file changes.
+            *(['--reload', '--reload-dir', project.dir] if project.hot_reload else []),
             f'{entry_point}:main',
-        ], env=env, stdout=PIPE, stderr=STDOUT)
+            env=project.app_env, stdout=PIPE, stderr=STDOUT,
+        )
     else:
-        return Popen([sys.executable, entry_point], env=env, stdout=PIPE, stderr=STDOUT)
+        return await asyncio.create_subprocess_exec(sys.executable, entry_point, env=project.script_env, stdout=PIPE, stderr=STDOUT)
 
 async def stop_previous(q: Q) -> None:
     # Stop script if any.
@@ -68,29 +97,59 @@ async def stop_previous(q: Q) -> None:
     # Stop app if any.
     if q.user.wave_process and q.user.wave_process.returncode is None:
         q.user.wave_process.terminate()
-        q.user.wave_process.wait()
+        await q.user.wave_process.wait()
     if q.user.display_logs_future:
         q.user.display_logs_future.cancel()
 
-async def setup_page(q: Q):
-    py_content = ''
+async def upload_snippets(q: Q):
+    # TODO: Serve snippets directly from static dir.
+    # Prod.
+    if os.path.exists('base-snippets.json') and os.path.exists('component-snippets.json'):
+        q.app.snippets1, q.app.snippets2, = await q.site.upload(['base-snippets.json', 'component-snippets.json'])
+    # When run in development from Wave repo.
+    elif os.path.exists(project.vsc_extension_path):
+        q.app.snippets1, q.app.snippets2, = await q.site.upload([
+            os.path.join(project.vsc_extension_path, 'base-snippets.json'),
+            os.path.join(project.vsc_extension_path, 'component-snippets.json')
+        ])
+
+async def load_static_content(q: Q):
+    autocomplete_paths = []
     # In prod.
     if os.path.exists('autocomplete_parser.py') and os.path.exists('autocomplete_utils.py'):
-        py_content = file_utils.read_file('autocomplete_parser.py')
-        py_content += file_utils.read_file('autocomplete_utils.py')
+        autocomplete_paths = ['autocomplete_parser.py', 'autocomplete_utils.py', 'autocomplete.py']
     # When run in development from Wave repo.
     elif os.path.exists(project.vsc_extension_path):
-        py_content = file_utils.read_file(os.path.join(project.vsc_extension_path, 'server', 'parser.py'))
-        py_content += file_utils.read_file(os.path.join(project.vsc_extension_path, 'server', 'utils.py'))
-    if py_content:
-        py_content += file_utils.read_file('autocomplete.py')
-    template = Template(file_utils.read_file('studio.js')).substitute(
+        autocomplete_paths = [
+            os.path.join(project.vsc_extension_path, 'server', 'parser.py'),
+            os.path.join(project.vsc_extension_path, 'server', 'utils.py'),
+            'autocomplete.py',
+        ]
+    # Files do not change at runtime, read them once for all clients.
+    js_content, *py_contents = await asyncio.gather(
+        *(q.run(file_utils.read_file, p) for p in ['studio.js', *autocomplete_paths])
+    )
+    q.app.js_template = Template(js_content)
+    q.app.autocomplete_url = ''
+    if py_contents:
+        # Let the browser fetch and cache the autocomplete sources instead of inlining them into every page.
+        fd, bundle_path = tempfile.mkstemp(suffix='.py')
+        os.close(fd)
+        try:
+            await q.run(file_utils.write_file, bundle_path, ''.join(py_contents))
+            q.app.autocomplete_url, = await q.site.upload([bundle_path])
+        finally:
+            os.remove(bundle_path)
+
+async def setup_page(q: Q):
+    file_content = await q.run(file_utils.read_file, project.entry_point)
+    template = q.app.js_template.substitute(
         snippets1=q.app.snippets1,
         snippets2=q.app.snippets2,
-        file_content=file_utils.read_file(project.entry_point) or '',
-        py_content=py_content,
+        file_content=json.dumps(file_content),
+        autocomplete_url=q.app.autocomplete_url,
         base_url=project.server_base_url,
-        folder=json.dumps(file_utils.get_file_tree(project.dir)),
+        folder=file_utils.get_file_tree_json(project.dir),
     )
     q.page['meta'] = ui.meta_card(
         box='',
@@ -138,13 +197,29 @@ async def setup_page(q: Q):
 </div>
     '''
     q.page['logs'] = ui.markdown_card(box=ui.box('main', width='0px'), title='Logs', content='')
-    q.page['code'] = ui.markup_card(box=ui.box('main', width='100%'), title='', content=editor_html)
+    # Lay out the page of a new client in the view last chosen by the user.
+    q.client.view = q.user.view or 'split'
+    q.page['code'] = ui.markup_card(box=_VIEWS[q.client.view][1], title='', content=editor_html)
     show_empty_preview(q)
 
+def set_view(q: Q, view: str) -> None:
+    preview_box, code_box, logs_box, toggle = _VIEWS[view]
+    if preview_box:
+        q.page['preview'].box = preview_box
+    if code_box:
+        q.page['code'].box = code_box
+    if logs_box:
+        q.page['logs'].box = logs_box
+    if toggle:
+        name, label, icon = toggle
+        q.page['header'].items[0].button.name = name
+        q.page['header'].items[0].button.label = label
+        q.page['header'].items[0].button.icon = icon
+
 def show_empty_preview(q: Q):
     del q.page['preview']
     q.page['preview'] = ui.tall_info_card(
-        box=ui.box('main', width=('0px' if q.user.view == "code" else '100%')),
+        box=ui.box('main', width=('0px' if q.client.view == "code" else '100%')),
         name='',
         image=project.get_assets_url_for('app_not_running.svg'),
         image_height='500px',
@@ -153,40 +228,55 @@ def show_empty_preview(q: Q):
     )
 
 async def display_logs(q: Q) -> None:
-  lines = []
-  p = q.user.wave_process
-  os.set_blocking(p.stdout.fileno(), False)
-  while True:
-      line = p.stdout.readline() 
-      if line:
-          lines.append(line.decode('utf8')) 
-          code = ''.join(lines)
-          q.page['logs'].content = f'```\n{code}\n```'
-          q.page['meta'].script = ui.inline_script('scrollLogsToBottom()')
-          await q.page.save()
-      else:
-          await q.sleep(0.5)
+    # Only show the tail of the logs, keeps the page payload bounded for long running apps.
+    lines = collections.deque(maxlen=1000)
+    p = q.user.wave_process
+    decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+    # Line cut at a read boundary, kept aside until it is complete so the deque only holds whole lines.
+    partial_line = ''
+    while True:
+        # Returns everything buffered so far, so chatty processes result in a single save per batch.
+        chunk = await p.stdout.read(64 * 1024)
+        if not chunk:
+            break
+        new_lines = (partial_line + decoder.decode(chunk)).splitlines(keepends=True)
+        partial_line = new_lines.pop() if new_lines and not new_lines[-1].endswith(('\n', '\r')) else ''
+        lines.extend(new_lines)
+        code = ''.join(lines) + partial_line
+        q.page['logs'].content = f'```\n{code}\n```'
+        q.page['meta'].script = ui.inline_script('scrollLogsToBottom()')
+        await q.page.save()
 
 async def render_code(q: Q):
     if q.events.editor:
-        code = file_utils.pythonify_js_code(q.events.editor.change if q.events.editor else '')
-        with open(q.client.opened_file, 'w') as f:
-            f.write(code)
+        code_hash = (q.client.opened_file, hashlib.blake2b(q.events.editor.change.encode(), digest_size=8).digest())
+        # Unchanged content, e.g. a repeated autosave, needs neither a write nor a restart.
+        if code_hash == q.client.code_hash:
+            return
+        q.client.code_hash = code_hash
+    # Drop restart scheduled by a previous change, if still pending.
+    if q.user.restart_future:
+        q.user.restart_future.cancel()
+        q.user.restart_future = None
+    # Keep the code in memory, the file is only read when there is no editor change to use.
+    if q.events.editor:
+        code = q.events.editor.change
+        await q.run(file_utils.write_file, q.client.opened_file, code)
         if not project.entry_point and ('@app(' in code or 'site[' in code):
             project.entry_point = q.client.opened_file
     else:
-        code = file_utils.read_file(q.client.opened_file)
+        code = await q.run(file_utils.read_file, q.client.opened_file)
 
     path = ''
     if q.client.opened_file == project.entry_point:
-        app_match = re.search('\n@app\(.*(\'|\")(.*)(\'|\")', code)
+        app_match = _APP_RE.search(code)
         if app_match:
-            path = app_match.group(2)
+            path = app_match.group(1)
             q.user.is_app = True
         else:
-            script_match = re.search('site\[(\'|\")(.*)(\'|\")\]', code)
+            script_match = _SITE_RE.search(code)
             if script_match:
-                path = script_match.group(2)
+                path = script_match.group(1)
                 q.user.is_app = False
         if not path:
             show_empty_preview(q)
@@ -194,15 +284,35 @@ async def render_code(q: Q):
             return
         q.user.active_path = path
 
-    await stop_previous(q)
-    q.user.wave_process = start(project.entry_point, q.user.is_app)
-    q.user.display_logs_future = asyncio.ensure_future(display_logs(q))
+    if q.events.editor:
+        # Coalesce bursts of editor changes, restart the app only once they settle.
+        q.user.restart_future = asyncio.ensure_future(restart_later(q, path))
+    else:
+        await restart(q, path)
+
+async def restart_later(q: Q, path: str, delay: float = 0.4):
+    await q.sleep(delay)
+    # Past this point the restart must not be cancelled halfway.
+    q.user.restart_future = None
+    await restart(q, path)
+    await q.page.save()
+
+async def restart(q: Q, path: str):
+    p = q.user.wave_process
+    # uvicorn only reloads on .py changes, other files (data, templates, ...) still require a respawn.
+    reloads = project.hot_reload and (q.client.opened_file or '').endswith('.py')
+    # A running app reloads itself on such changes, respawn only when a different app is to be served.
+    if not (reloads and q.user.is_app and p and p.returncode is None and q.user.app_entry_point == project.entry_point):
+        await stop_previous(q)
+        q.user.wave_process = await start(project.entry_point, q.user.is_app)
+        q.user.app_entry_point = project.entry_point if q.user.is_app else None
+        q.user.display_logs_future = asyncio.ensure_future(display_logs(q))
     del q.page['empty']
 
     path = path or q.user.active_path
     path = '' if path == '/' else path
     q.page['preview'] = ui.frame_card(
-        box=ui.box('main', width=('0px' if q.user.view == 'code' else '100%')),
+        box=ui.box('main', width=('0px' if q.client.view == 'code' else '100%')),
         title=f'Preview of {project.server_adress}{path}',
         path=f'{project.server_adress}{path}'
     )
@@ -214,30 +324,40 @@ async def on_startup():
     app_path = Path(project.entry_point)
     if not app_path.exists():
         shutil.copy('starter.py', app_path)
+    # Read project files once so that the first app start hits the OS page cache instead of the disk.
+    asyncio.get_event_loop().run_in_executor(None, file_utils.warm_page_cache, project.dir)
 
 async def on_shutdown():
     file_utils.remove_folder(project.dir)
 
 async def export(q: Q):
-    shutil.make_archive('app', 'zip', '.', project.dir)
-    q.app.zip_path, = await q.site.upload(['app.zip'])
-    q.page["meta"].script = ui.inline_script(f'window.open("{q.app.zip_path}", "_blank");')
-    os.remove("app.zip")
+    # Each export gets its own folder so that concurrent exports do not overwrite or remove each other's archive.
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # Walking and compressing the project can take a while, do not block other clients meanwhile.
+        zip_path = await q.run(shutil.make_archive, os.path.join(tmp_dir, 'app'), 'zip', '.', project.dir)
+        zip_url, = await q.site.upload([zip_path])
+    finally:
+        shutil.rmtree(tmp_dir)
+    q.page["meta"].script = ui.inline_script(f'window.open("{zip_url}", "_blank");')
 
 @app('/studio', on_startup=on_startup, on_shutdown=on_shutdown)
 async def serve(q: Q):
     if not q.app.initialized:
-        # TODO: Serve snippets directly from static dir.
-        # Prod.
-        if os.path.exists('base-snippets.json') and os.path.exists('component-snippets.json'):
-            q.app.snippets1, q.app.snippets2, = await q.site.upload(['base-snippets.json', 'component-snippets.json'])
-        # When run in development from Wave repo.
-        elif os.path.exists(project.vsc_extension_path):
-            q.app.snippets1, q.app.snippets2, = await q.site.upload([
-                os.path.join(project.vsc_extension_path, 'base-snippets.json'),
-                os.path.join(project.vsc_extension_path, 'component-snippets.json')
-            ])
-        q.app.initialized = True
+        if not q.app.init_lock:
+            q.app.init_lock = asyncio.Lock()
+        # Clients connecting at once, e.g. reconnecting tabs after a restart, must initialize the app only once.
+        async with q.app.init_lock:
+            if not q.app.initialized:
+                # Independent I/O, overlap network uploads with disk reads.
+                _, _, tree = await asyncio.gather(
+                    upload_snippets(q),
+                    load_static_content(q),
+                    q.run(file_utils.get_file_tree, project.dir),
+                )
+                # Only the walk runs in a thread, the shared tree cache is filled on the event loop.
+                file_utils.set_file_tree(project.dir, tree)
+                q.app.initialized = True
     if not q.client.initialized:
         await setup_page(q)
         q.client.opened_file = project.entry_point
@@ -245,8 +365,12 @@ async def serve(q: Q):
         await render_code(q)
 
     if q.args.dropdown:
-        q.user.view = q.args.dropdown
-        q.page['header'].items[2].dropdown.value = q.args.dropdown
+        # Do not resend the header if the view did not change.
+        if q.args.dropdown != q.client.view:
+            q.user.view = q.args.dropdown
+            q.client.view = q.args.dropdown
+            q.page['header'].items[2].dropdown.value = q.args.dropdown
+            set_view(q, q.args.dropdown)
     elif q.args.export_project:
         await export(q)
     elif q.args.import_project:
@@ -272,39 +396,29 @@ async def serve(q: Q):
                 )
                 project.dir = root_dirs[0].filename.replace(os.path.sep, '')
                 project.entry_point = file_utils.find_main_file(project.dir)
+                # Watched project folder was replaced, reloading is not enough.
+                q.user.app_entry_point = None
                 q.client.opened_file = project.entry_point
+                q.client.code_hash = None
                 await render_code(q)
                 editor.update_file_tree(q, project.dir)
                 await q.page.save()
-                editor.open_file(q, project.entry_point)
+                await editor.open_file(q, project.entry_point)
             else:
                 q.page['meta'].dialog.items = [
                     ui.message_bar(type='error', text='There must be exactly 1 root folder.'),
                     ui.button(name='import_project', label='Import again', icon='Upload'),
                 ]
-    elif q.args.dropdown == 'code':
-        q.page['preview'].box = ui.box('main', width='0px')
-        q.page['code'].box = ui.box('main', width='100%')
-    elif q.args.dropdown == 'split':
-        q.page['preview'].box = ui.box('main', width='100%')
-        q.page['code'].box = ui.box('main', width='100%')
-    elif q.args.dropdown == 'preview':
-        q.page['preview'].box = ui.box('main', width='100%')
-        q.page['code'].box = ui.box('main', width='0px')
     elif q.args.console:
-        q.page['preview'].box = ui.box('main', width='100%')
-        q.page['code'].box = ui.box('main', width='0px')
-        q.page['logs'].box = ui.box('main', width='100%')
-        q.page['header'].items[0].button.name = 'show_code'
-        q.page['header'].items[0].button.label = 'Code'
-        q.page['header'].items[0].button.icon = 'Code'
+        if not q.client.console_shown:
+            q.client.console_shown = True
+            set_view(q, 'console')
     elif q.args.show_code:
-        q.page['preview'].box = ui.box('main', width='100%')
-        q.page['logs'].box = ui.box('main', width='0px')
-        q.page['code'].box = ui.box('main', width='100%')
-        q.page['header'].items[0].button.name = 'console'
-        q.page['header'].items[0].button.label = 'Console'
-        q.page['header'].items[0].button.icon = 'CommandPrompt'
+        if q.client.console_shown:
+            q.client.console_shown = False
+            set_view(q, 'show_code')
+            # Go back to the layout of the view selected in the dropdown.
+            set_view(q, q.client.view)
 
     if q.events.editor:
         await render_code(q)
@@ -317,7 +431,7 @@ async def serve(q: Q):
         if e.new_file:
             new_file = os.path.join(e.new_file['path'], e.new_file['name'])
             file_utils.create_file(new_file)
-            editor.open_file(q, new_file)
+            await editor.open_file(q, new_file)
             await q.page.save()
         elif e.new_folder:
             file_utils.create_folder(os.path.join(e.new_folder['path'], e.new_folder['name']))
@@ -359,7 +473,7 @@ async def serve(q: Q):
             file_utils.rename(path, new_name)
         elif e.open:
             q.client.opened_file = e.open
-            editor.open_file(q, e.open)
+            await editor.open_file(q, e.open)
             await q.page.save()
         editor.update_file_tree(q, project.dir)
 
@@ -3,13 +3,17 @@ import json
 import file_utils
 
 def update_file_tree(q: Q, root: str) -> None:
-    q.page['meta'].script = ui.inline_script(f'eventBus.emit("folder", {json.dumps(file_utils.get_file_tree(root))})')
+    q.page['meta'].script = ui.inline_script(f'eventBus.emit("folder", {file_utils.get_file_tree_json(root)})')
 
-def open_file(q: Q, file: str) -> None:
+async def open_file(q: Q, file: str) -> None:
+    content = await q.run(file_utils.read_file, file)
+    # Editor content now comes from disk, the next change must not be compared against a stale hash.
+    q.client.code_hash = None
     q.page['meta'].script = ui.inline_script(f'''
-editor.setValue(`{file_utils.read_file(file)}`)
-eventBus.emit('activeFile', '{file}')
+editor.setValue({json.dumps(content)})
+eventBus.emit('activeFile', {json.dumps(file)})
 ''')
 
 def clean_editor(q: Q) -> None:
+    q.client.code_hash = None
     q.page['meta'].script = ui.inline_script(f'editor.setValue(``)')